@@ -149,6 +149,7 @@ def safe_log(x, eps=1e-10):
     result : numpy array
 """
 
-    result = np.where(x > eps, x, -10)
+    # fill value matches the input dtype so single precision inputs stay single precision
+    result = np.where(x > eps, x, np.array(-10, dtype=np.asarray(x).dtype))
     np.log(result, out=result, where=result > 0)
     return result
@@ -287,10 +287,7 @@ def main(
 
     # calc temperature based weighting function
     w_t = (alt_grid - meltlayer) / (neg20layer - meltlayer)
-    w_t[alt_grid <= meltlayer] = 0
-    w_t[alt_grid >= neg20layer] = 1
-    w_t[w_t < 0] = 0
-    w_t[w_t > 1] = 1
+    np.clip(w_t, 0, 1, out=w_t)
 
     # calc severe hail index
     d_z = alt_vec[1] - alt_vec[0]
@@ -324,12 +321,11 @@ def main(
 
     # calc warning threshold (J/m/s) NOTE: freezing height must be in km
     warning_threshold = 57.5 * (meltlayer / 1000) - 121
+    inv_warning_threshold = 1.0 / warning_threshold
 
     # calc probability of severe hail (POSH) (%)
-    posh = 29 * common.safe_log(shi / warning_threshold) + 50
-    posh = np.real(posh)
-    posh[posh < 0] = 0
-    posh[posh > 100] = 100
+    posh = 29.0 * common.safe_log(shi * inv_warning_threshold) + 50.0
+    np.clip(posh, 0.0, 100.0, out=posh)
 
     # apply speckle filter
     if speckle_filter:
@@ -6,9 +6,18 @@ Joshua Soderholm - 15 August 2020
 """
 
 import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 import numpy as np
+from numba import jit, prange
+from scipy.spatial import cKDTree
 from pyhail import common
 
+# hail kinetic energy coefficients, 10 ** (0.084 * Z) is evaluated as exp(0.084 * ln(10) * Z)
+_KE_COEF = 5.0e-6
+_KE_K = 0.084 * np.log(10.0)
+
 
 def pyart(
     radar,
@@ -233,23 +242,23 @@ def pyodim(
         column_shift_maximum=column_shift_maximum,
     )
 
-    # add 2D fields and metadata
+    # add 2D fields and metadata to the lowest sweep
     sweep0_idx = np.argmin(elevation_dataset)
-    datasets[sweep0_idx] = datasets[0].merge(
+    datasets[sweep0_idx] = datasets[sweep0_idx].merge(
         {
             shi_fname: (("azimuth", "range"), shi_dict["data"]),
             mesh_fname: (("azimuth", "range"), mesh_dict["data"]),
             posh_fname: (("azimuth", "range"), posh_dict["data"]),
         }
     )
-    datasets[0][shi_fname] = common.add_pyodim_metadata(
-        datasets[0][shi_fname], shi_dict
+    datasets[sweep0_idx][shi_fname] = common.add_pyodim_metadata(
+        datasets[sweep0_idx][shi_fname], shi_dict
     )
-    datasets[0][mesh_fname] = common.add_pyodim_metadata(
-        datasets[0][mesh_fname], mesh_dict
+    datasets[sweep0_idx][mesh_fname] = common.add_pyodim_metadata(
+        datasets[sweep0_idx][mesh_fname], mesh_dict
     )
-    datasets[0][posh_fname] = common.add_pyodim_metadata(
-        datasets[0][posh_fname], posh_dict
+    datasets[sweep0_idx][posh_fname] = common.add_pyodim_metadata(
+        datasets[sweep0_idx][posh_fname], posh_dict
     )
 
     # add 3D field and metadata
@@ -270,15 +279,15 @@ def _antenna_to_arc(ranges, elevation):
     Return the great circle distance directly below the radar beam and the
     altitude of the radar beam.
     ----------
-    ranges : 1d array
+    ranges : array
         Distances to the center of the radar gates (bins) in meters.
-    elevation : float
-        Elevation angle of the radar in degrees.
+    elevation : float or array
+        Elevation angle of the radar in degrees, must broadcast against ranges.
     Returns
     -------
-    s: 1d array
+    s: array
         Distance along the great circle for each radar bin (units: meters)
-    z: 1d array
+    z: array
         Altitude above radar level for each radar bin (units: meters)
     Notes
     -----
@@ -301,42 +310,181 @@ def _antenna_to_arc(ranges, elevation):
     R = 6371.0 * 1000.0 * 4.0 / 3.0  # effective radius of earth in meters.
     r = ranges
 
-    z = (r**2 + R**2 + 2.0 * r * R * np.sin(theta_e)) ** 0.5 - R
+    z = np.sqrt(r * r + R * R + 2.0 * r * R * np.sin(theta_e)) - R
     s = R * np.arcsin(r * np.cos(theta_e) / (R + z))  # arc length in m.
     return s, z
 
 
+def _match_sweep(s_pts, az_pts, sweep0_s_pts, sweep0_az_pts, column_shift_maximum):
+    """
+    Find the range bin and ray of a sweep closest to each sweep0 (lowest) range bin and ray
+
+    Parameters
+    ----------
+    s_pts : 2darray
+        great circle arc distance (m) of each range bin in the sweep (dim: range, 1)
+    az_pts : 2darray
+        azimuth angle in [0, 360) of each ray in the sweep (dim: azimuth, 1)
+    sweep0_s_pts : 2darray
+        great circle arc distance (m) of each range bin in sweep0 (dim: range, 1)
+    sweep0_az_pts : 2darray
+        azimuth angle in [0, 360) of each ray in sweep0 (dim: azimuth, 1)
+    column_shift_maximum: float
+        maximum horizontal distance a column can shift by
+
+    Returns
+    -------
+    closest_rng_idx : 1darray
+        range bin index for each sweep0 range bin, -1 where the column shift is too large
+    closest_az_idx : 1darray
+        ray index for each sweep0 ray, -1 where the azimuth differs by more than 1 degree
+    """
+    # find closest range bin using great circle arc to sweep0 (lowest) location
+    # skip where the horizontal shift is greater than column_shift_maximum (removes birdbaths and when base scan max range is greater than all other scans)
+    s_tree = cKDTree(s_pts, balanced_tree=False, compact_nodes=False)
+    _, closest_rng_idx = s_tree.query(
+        sweep0_s_pts, distance_upper_bound=column_shift_maximum
+    )
+    closest_rng_idx[closest_rng_idx == s_tree.n] = -1
+    # find closest azimuth (periodic), skip where the azimuth differs by more than 1 degree from sweep0
+    az_tree = cKDTree(az_pts, boxsize=360, balanced_tree=False, compact_nodes=False)
+    az_diff, closest_az_idx = az_tree.query(sweep0_az_pts)
+    closest_az_idx[az_diff > 1] = -1
+    return closest_rng_idx, closest_az_idx
+
+
 def _calc_dz(column_z):
     """
-    Calculate altitude difference between elements in a 1d array
-    Takes into account the boundaries
+    Calculate altitude difference between elements along the elevation axis
+    Takes into account the boundaries and sweeps missing from the column
 
     Parameters
     ----------
-    column_z : 1darray
-        altitude of column samples
+    column_z : 2darray
+        altitude of column samples (dim: range, elevation), nan where a sweep is not in the column
 
     Returns
     -------
-    dz : 1darray
-        Difference between altitude elements
+    dz : 2darray
+        Difference between altitude elements, zero where a sweep is not in the column
     """
-    # need at least two values
-    dz = []
-    n_ppi = len(column_z)
-    for i in range(n_ppi):
-        # calculate dz for use in shi calc
-        if i == 0:
-            value = column_z[i + 1] - column_z[i]
-        elif (i != 0) & (i != n_ppi - 1):
-            value = (column_z[i + 1] - column_z[i - 1]) / 2
-        else:
-            value = column_z[i] - column_z[i - 1]
-        dz.append(value)
-    dz = np.array(dz)
+    n_ppi = column_z.shape[1]
+    valid = ~np.isnan(column_z)
+    sweep_idx = np.arange(n_ppi)
+    # index of the closest valid sample below and above each element (-1 or n_ppi if none)
+    prev_idx = np.full(column_z.shape, -1)
+    prev_idx[:, 1:] = np.maximum.accumulate(np.where(valid, sweep_idx, -1), axis=1)[
+        :, :-1
+    ]
+    next_idx = np.full(column_z.shape, n_ppi)
+    next_idx[:, :-1] = np.minimum.accumulate(
+        np.where(valid, sweep_idx, n_ppi)[:, ::-1], axis=1
+    )[:, ::-1][:, 1:]
+    has_prev = prev_idx >= 0
+    has_next = next_idx < n_ppi
+    prev_z = np.take_along_axis(column_z, np.where(has_prev, prev_idx, 0), axis=1)
+    next_z = np.take_along_axis(column_z, np.where(has_next, next_idx, 0), axis=1)
+    # central difference inside the column, one sided at the lowest and highest sample
+    dz = np.select(
+        [
+            valid & has_prev & has_next,
+            valid & ~has_prev & has_next,
+            valid & has_prev & ~has_next,
+        ],
+        [(next_z - prev_z) / 2, next_z - column_z, column_z - prev_z],
+        default=0.0,
+    )
     return dz
 
 
+# fastmath flags exclude nnan/ninf so the nan reflectivity check is not optimised away
+# compiled eagerly for any array layout and cached to disk, so no jit compilation happens on the first call
+@jit(
+    "void(float32[:, :], float64, float64, float32[:, :])",
+    nopython=True,
+    parallel=True,
+    fastmath={"nsz", "arcp", "contract", "afn", "reassoc"},
+    cache=True,
+)
+def _hail_ke(reflectivity, z_l, z_u, hail_ke):
+    """
+    Calculate hail kinetic energy for a sweep in a single pass
+
+    Parameters
+    ----------
+    reflectivity : 2darray
+        sweep reflectivity data (dim: azimuth, range)
+    z_l : float
+        lower reflectivity boundary for the rain/hail weighting function (dBZ)
+    z_u : float
+        upper reflectivity boundary for the rain/hail weighting function (dBZ)
+    hail_ke : 2darray
+        output array for hail kinetic energy (dim: azimuth, range), set to zero where reflectivity is nan
+    """
+    nrays, nbins = reflectivity.shape
+    inv_z_span = 1.0 / (z_u - z_l)
+    for az_idx in prange(nrays):
+        for rg_idx in range(nbins):
+            refl = reflectivity[az_idx, rg_idx]
+            if np.isnan(refl):
+                hail_ke[az_idx, rg_idx] = 0.0
+                continue
+            # weights for hail kenetic energy
+            refl_weight = min(1.0, max(0.0, (refl - z_l) * inv_z_span))
+            # limit on DBZ
+            refl = min(100.0, max(-100.0, refl))
+            hail_ke[az_idx, rg_idx] = _KE_COEF * np.exp(_KE_K * refl) * refl_weight
+
+
+def _accumulate_shi(hail_ke_stack, wt_stack, az_lookup, rng_lookup, dz_lookup):
+    """
+    Integrate the SHI elements of each column above the lowest sweep
+
+    Parameters
+    ----------
+    hail_ke_stack : 3darray
+        hail kinetic energy for each sweep (dim: elevation, azimuth, range)
+    wt_stack : 2darray
+        temperature weighting value for each sweep (dim: elevation, range)
+    az_lookup : 2darray
+        ray index to use from each sweep for each sweep0 ray (dim: azimuth, elevation), -1 for skipped sweeps
+    rng_lookup : 2darray
+        range bin index to use from each sweep for each sweep0 range bin (dim: range, elevation), -1 for skipped sweeps
+    dz_lookup : 2darray
+        altitude dz for shi integration (dim: range, elevation)
+
+    Returns
+    -------
+    shi : 2darray
+        severe hail index on sweep0 coordinates (dim: azimuth, range)
+    """
+    sweep0_nrays = az_lookup.shape[0]
+    sweep0_nbins = rng_lookup.shape[0]
+    # WT and DZ only vary with range so are broadcast across azimuth.
+    # skipped sweeps (index -1) are zeroed through the weights rather than a 2d mask
+    rng_weights = np.where(
+        rng_lookup >= 0,
+        np.take_along_axis(wt_stack, rng_lookup.T, axis=1).T * dz_lookup,
+        0.0,
+    ).astype(np.float32)
+    az_weights = (az_lookup >= 0).astype(np.float32)
+    # gather buffers are reused for every sweep, mode="wrap" lets np.take write into them directly
+    # (the -1 index of skipped sweeps wraps to the last element and is zeroed by the weights)
+    shi = np.zeros((sweep0_nrays, sweep0_nbins), dtype=np.float32)
+    rays = np.empty((sweep0_nrays, hail_ke_stack.shape[2]), dtype=np.float32)
+    contrib = np.empty((sweep0_nrays, sweep0_nbins), dtype=np.float32)
+    for sweep_idx, hail_ke in enumerate(hail_ke_stack):
+        np.take(hail_ke, az_lookup[:, sweep_idx], axis=0, out=rays, mode="wrap")
+        np.take(rays, rng_lookup[:, sweep_idx], axis=1, out=contrib, mode="wrap")
+        # HKE * WT * DZ
+        contrib *= rng_weights[:, sweep_idx]
+        contrib *= az_weights[:, sweep_idx, np.newaxis]
+        shi += contrib
+    # insert into SHI if there's a valid value
+    shi = np.where(shi > 0, 0.1 * shi, 0.0)
+    return shi
+
+
 def main(
     reflectivity,
     elevation,
@@ -408,12 +556,25 @@ def main(
     meltlayer = np.min(levels)
     neg20layer = np.max(levels)
 
-    # sort by fixed angle
-    sort_idx = list(np.argsort(elevation))
-    reflectivity_dataset = [reflectivity[i] for i in sort_idx]
-    elevation_dataset = [elevation[i] for i in sort_idx]
-    azimuth_dataset = [azimuth[i] for i in sort_idx]
-    range_dataset = [rangebin[i] for i in sort_idx]
+    # sort by fixed angle, stacking sweeps first when they share the same shape
+    sort_idx = np.argsort(elevation)
+    elevation_dataset = np.asarray(elevation)[sort_idx]
+    # reflectivity is processed in single precision
+    if all(np.shape(refl) == np.shape(reflectivity[0]) for refl in reflectivity):
+        reflectivity_dataset = np.asarray(reflectivity, dtype=np.float32)[sort_idx]
+    else:
+        # copy so the C band correction can be applied in place
+        reflectivity_dataset = [
+            np.array(reflectivity[i], dtype=np.float32) for i in sort_idx
+        ]
+    if all(len(azi) == len(azimuth[0]) for azi in azimuth):
+        azimuth_dataset = np.asarray(azimuth)[sort_idx]
+    else:
+        azimuth_dataset = [azimuth[i] for i in sort_idx]
+    if all(len(rng) == len(rangebin[0]) for rng in rangebin):
+        range_dataset = np.asarray(rangebin)[sort_idx]
+    else:
+        range_dataset = [rangebin[i] for i in sort_idx]
 
     # require more than one sweep
     if len(elevation_dataset) <= minimum_sweeps_raise_expection:
@@ -435,138 +596,102 @@ def main(
         )
 
     # Initialize sweep coords
-    sweep0_nrays = len(azimuth_dataset[0])
-    sweep0_nbins = len(range_dataset[0])
     n_ppi = len(elevation_dataset)
-    z_dataset = (
-        []
-    )  # list (dim: elevation) of 1d array (dim: range) for each sweep, altitude above ground level (m) of each range bin
-    s_dataset = (
-        []
-    )  # list (dim: elevation) of 1d array (dim: range) for each sweep, great circle arc distance (m) of each radar bin
-    wt_dataset = (
-        []
-    )  # list (dim: elevation) of 1d array (dim: range) for each sweep, temperature weighting value
-    hail_ke_dataset = (
-        []
-    )  # list (dim: elevation) of 2d array (dim: azimuth, range) for each sweep, hail kinetic energy
+    nrays_dataset = [len(azimuth) for azimuth in azimuth_dataset]
+    nbins_dataset = [len(rangebin) for rangebin in range_dataset]
+    sweep0_nrays = nrays_dataset[0]
+    sweep0_nbins = nbins_dataset[0]
+    max_nrays = max(nrays_dataset)
+    max_nbins = max(nbins_dataset)
+    # sweeps with fewer rays or bins are padded (nan for coordinates, zero for weights)
+    # coordinates are kept in double precision as z = sqrt(r^2 + R^2 + ...) - R loses ~1 m in float32
+    range_stack = np.full((n_ppi, max_nbins), np.nan)
+    for i in range(n_ppi):
+        range_stack[i, : nbins_dataset[i]] = range_dataset[i]
+    # calculate cartesian coordinates for all sweeps
+    s_stack, z_stack = _antenna_to_arc(
+        range_stack, np.array(elevation_dataset)[:, np.newaxis]
+    )  # 2d arrays (dim: elevation, range), great circle arc distance (m) and altitude above radar level (m) of each range bin
+    z_stack += radar_altitude
+    # surface range of the lowest sweep and range limits for the retrieval
+    sweep0_s = s_stack[0, :sweep0_nbins]
+    range_mask = sweep0_s < min_range * 1000
+    np.logical_or(range_mask, sweep0_s > max_range * 1000, out=range_mask)
+    wt_stack = np.zeros(
+        (n_ppi, max_nbins), dtype=np.float32
+    )  # 2d array (dim: elevation, range), temperature weighting value
+    hail_ke_stack = np.zeros(
+        (n_ppi, max_nrays, max_nbins), dtype=np.float32
+    )  # 3d array (dim: elevation, azimuth, range), hail kinetic energy
+    inv_t_span = 1.0 / (neg20layer - meltlayer)
+    # C band correction
+    apply_cband_correction = radar_band == "C" and correct_cband_refl
     hail_refl_correction_description = ""
+    if apply_cband_correction:
+        hail_refl_correction_description = (
+            "C band hail reflectivity correction applied"
+            " from Brook et al. 2023 https://arxiv.org/abs/2306.12016"
+        )
     for i in range(n_ppi):
-        # calculate cartesian coordinates
-        s, z = _antenna_to_arc(range_dataset[i], elevation_dataset[i])
-        s_dataset.append(s)
-        z_dataset.append(z + radar_altitude)
+        nrays = nrays_dataset[i]
+        nbins = nbins_dataset[i]
         # calc temperature based weighting function
-        wt = (z_dataset[i] - meltlayer) / (neg20layer - meltlayer)
-        wt[z_dataset[i] <= meltlayer] = 0
-        wt[z_dataset[i] >= neg20layer] = 1
-        wt[wt < 0] = 0
-        wt[wt > 1] = 1
-        wt_dataset.append(wt)
+        wt = wt_stack[i, :nbins]
+        np.multiply(z_stack[i, :nbins] - meltlayer, inv_t_span, out=wt)
+        np.clip(wt, 0, 1, out=wt)
         # apply C band correction
-        if radar_band == "C" and correct_cband_refl:
-            reflectivity_dataset[i] = reflectivity_dataset[i] * 1.113 - 3.929
-            hail_refl_correction_description = (
-                "C band hail reflectivity correction applied"
-                " from Brook et al. 2023 https://arxiv.org/abs/2306.12016"
-            )
-        # calc weights for hail kenetic energy
-        reflectivity_weights = (reflectivity_dataset[i] - z_l) / (z_u - z_l)
-        reflectivity_weights[reflectivity_dataset[i] <= z_l] = 0
-        reflectivity_weights[reflectivity_dataset[i] >= z_u] = 1
-        reflectivity_weights[reflectivity_weights < 0] = 0
-        reflectivity_weights[reflectivity_weights > 1] = 1
-        # limit on DBZ
-        reflectivity_dataset[i][reflectivity_dataset[i] > 100] = 100
-        reflectivity_dataset[i][reflectivity_dataset[i] < -100] = -100
+        if apply_cband_correction:
+            np.multiply(reflectivity_dataset[i], 1.113, out=reflectivity_dataset[i])
+            reflectivity_dataset[i] -= 3.929
         # calc hail kenetic energy
-        hail_ke = (
-            (5.0e-6) * 10 ** (0.084 * reflectivity_dataset[i]) * reflectivity_weights
+        _hail_ke(reflectivity_dataset[i], z_l, z_u, hail_ke_stack[i, :nrays, :nbins])
+
+    # generate arc range, azimuth and dz lookup (note these have different dimensions to the dimension variables)
+    rng_lookup = np.full(
+        (sweep0_nbins, n_ppi), -1, dtype=np.int64
+    )  # 2d array (dim: range, elevation), range bin index to use from each sweep for each sweep0 range bin, -1 where the sweep is skipped. ASSUMES ORDERS SWEEP ELEVATION
+    az_lookup = np.full(
+        (sweep0_nrays, n_ppi), -1, dtype=np.int64
+    )  # 2d array (dim: azimuth, elevation), ray index to use from each sweep for each sweep0 ray, -1 where the sweep is skipped
+    rng_lookup[:, 0] = np.arange(sweep0_nbins)
+    az_lookup[:, 0] = np.arange(sweep0_nrays)
+    # contiguous (n, 1) point arrays for each sweep, azimuth wrapped into [0, 360) for the periodic tree
+    s_pts_dataset = []
+    az_pts_dataset = []
+    for i in range(n_ppi):
+        s_pts_dataset.append(
+            np.ascontiguousarray(s_stack[i, : nbins_dataset[i], np.newaxis])
+        )
+        az_pts = np.mod(np.asarray(azimuth_dataset[i], dtype=np.float64), 360)
+        az_pts[az_pts >= 360] = 0
+        az_pts_dataset.append(np.ascontiguousarray(az_pts[:, np.newaxis]))
+    # match each upper sweep to the sweep0 columns, sweeps are independent so run them concurrently
+    with ThreadPoolExecutor(max_workers=min(n_ppi - 1, os.cpu_count() or 1)) as executor:
+        sweep_matches = executor.map(
+            _match_sweep,
+            s_pts_dataset[1:],
+            az_pts_dataset[1:],
+            repeat(s_pts_dataset[0]),
+            repeat(az_pts_dataset[0]),
+            repeat(column_shift_maximum),
         )
-        hail_ke[np.isnan(hail_ke)] = 0
-        hail_ke_dataset.append(hail_ke)
-
-    # generate arc range and dz lookup (note these have different dimensions to the dimension variables)
-    dz_dataset = (
-        []
-    )  # list (dim: range) where each element represents a range bin, 1d array (dim: elevation) where each element represents a sweep, altitude dz for shi integration (m)
-    s_lookup_dataset = (
-        []
-    )  # list (dim: range) where each element represents an the range bin index to use from each sweep above sweep0. ASSUMES ORDERS SWEEP ELEVATION
-    for rg_idx in range(sweep0_nbins):
-        s_lookup = [0]
-        column_z = [z_dataset[0][rg_idx]]
-        for sweep_idx in range(1, n_ppi, 1):
-            dist_array = np.abs(s_dataset[0][rg_idx] - s_dataset[sweep_idx])
-            closest_rng_idx = np.argmin(dist_array)
-            # skip sweeps where the horizontal shift is greater than column_shift_maximum (removes birdbaths and when base scan max range is greater than all other scans)
-            if dist_array[closest_rng_idx] < column_shift_maximum:
-                s_lookup.append(closest_rng_idx)
-                column_z.append(z_dataset[sweep_idx][closest_rng_idx])
-            # else:
-            #     print('skipping', 'distance check', dist_array[closest_rng_idx], 'range idx', rg_idx, 'sweep idx', sweep_idx)
-        # check if at least two valid values in the column exists
-        if len(s_lookup) > 1:
-            s_lookup_dataset.append(np.array(s_lookup))
-            dz_dataset.append(_calc_dz(column_z))
-        else:
-            s_lookup_dataset.append(None)
-            dz_dataset.append(None)
+        for sweep_idx, (closest_rng_idx, closest_az_idx) in enumerate(
+            sweep_matches, start=1
+        ):
+            rng_lookup[:, sweep_idx] = closest_rng_idx
+            az_lookup[:, sweep_idx] = closest_az_idx
+    column_z = np.where(
+        rng_lookup >= 0, z_stack[np.arange(n_ppi), rng_lookup], np.nan
+    )  # 2d array (dim: range, elevation), altitude of each sample in the sweep0 columns
+    dz_lookup = _calc_dz(column_z).astype(
+        np.float32
+    )  # 2d array (dim: range, elevation), altitude dz for shi integration (m)
 
     # calculate shi on lowest sweep coordinates
-    shi = np.zeros((len(azimuth_dataset[0]), len(range_dataset[0])))
-    shi_mask = np.zeros((len(azimuth_dataset[0]), len(range_dataset[0])), dtype=bool)
-    # loop through each ray in the lowest sweep
-    for az_idx in range(sweep0_nrays):
-        sweep0_az = azimuth_dataset[0][az_idx]
-        # loop through each range bin for the ray
-        for rg_idx in range(sweep0_nbins):
-            # check if sweep0 (lowest) range is outside of limits
-            if (
-                s_dataset[0][rg_idx] < min_range * 1000
-                or s_dataset[0][rg_idx] > max_range * 1000
-            ):
-                shi_mask[az_idx, rg_idx] = True
-                continue
-            # check if a valid column exists at this range
-            if s_lookup_dataset[rg_idx] is None:
-                shi_mask[az_idx, rg_idx] = True
-                continue
-            # init shi elements
-            column_shi_elements = [
-                hail_ke_dataset[0][az_idx, rg_idx] * wt_dataset[0][rg_idx]
-            ]  # HKE * WT
-            # loop through the sweep entries in the lookup table. ASSUMES ORDERED SWEEPS, AS IT WILL REMOVE BIRDBATH SCANS THAT FALL AT THE END OF THE VOLUME
-            for sweep_idx in range(1, len(s_lookup_dataset[rg_idx]), 1):
-                #check if sweep azimuth value matches sweep0
-                search_azi = True
-                try:
-                    if sweep0_az == azimuth_dataset[sweep_idx][az_idx]:
-                        search_azi = False
-                except Exception as e:
-                    #will fall if index exceeds array size
-                    pass
-                if search_azi:
-                    # if not, find nearest azi
-                    closest_az_idx = np.argmin(np.abs(azimuth_dataset[sweep_idx]-sweep0_az))
-                    #if the azimuth differs by more than 1 degree from sweep0, use a value of -999 in the shi calculation.
-                    if azimuth_dataset[sweep_idx][closest_az_idx] - sweep0_az > 1:
-                        column_shi_elements.append(-999)
-                        continue
-                else:
-                    closest_az_idx = az_idx
-                # find closest point using great circle arc to sweep0 (lowest) location
-                closest_rng_idx = s_lookup_dataset[rg_idx][sweep_idx]
-                column_shi_elements.append(
-                    hail_ke_dataset[sweep_idx][closest_az_idx, closest_rng_idx]
-                    * wt_dataset[sweep_idx][closest_rng_idx]
-                )
-            # insert into SHI if there's a valid value
-            if np.max(column_shi_elements) > 0:
-                valid_sweep_idx = column_shi_elements != -999
-                shi[az_idx, rg_idx] = 0.1 * np.sum(
-                    column_shi_elements * dz_dataset[rg_idx][valid_sweep_idx]
-                )
+    shi = _accumulate_shi(hail_ke_stack, wt_stack, az_lookup, rng_lookup, dz_lookup)
+    # mask where sweep0 (lowest) range is outside of limits or no valid column exists at this range
+    shi_mask = np.logical_or(range_mask, np.all(rng_lookup[:, 1:] < 0, axis=1))
+    shi_mask = np.broadcast_to(shi_mask, shi.shape)
 
     # calc maximum estimated severe hail (mm)
     if (
@@ -601,20 +726,24 @@ def main(
 
     # calc warning threshold (J/m/s) NOTE: freezing height must be in km
     warning_threshold = 57.5 * (meltlayer / 1000) - 121
+    inv_warning_threshold = np.float32(1.0 / warning_threshold)
 
     # calc probability of severe hail (POSH) (%)
-    posh = 29 * common.safe_log(shi / warning_threshold) + 50
-    posh = np.real(posh)
-    posh[posh < 0] = 0
-    posh[posh > 100] = 100
+    posh = 29.0 * common.safe_log(shi * inv_warning_threshold) + 50.0
+    np.clip(posh, 0.0, 100.0, out=posh)
 
     # mask outside of coverage with nan
-    posh[shi_mask] = np.nan
-    shi[shi_mask] = np.nan
-    mesh[shi_mask] = np.nan
+    np.copyto(posh, np.nan, where=shi_mask)
+    np.copyto(shi, np.nan, where=shi_mask)
+    np.copyto(mesh, np.nan, where=shi_mask)
 
     # add grids to radar object
-    # unpack E into cfradial representation
+    # unpack E into cfradial representation, returned in the same sweep order as the input
+    hail_ke_dataset = [None] * n_ppi
+    for i, input_idx in enumerate(sort_idx):
+        hail_ke_dataset[input_idx] = hail_ke_stack[
+            i, : nrays_dataset[i], : nbins_dataset[i]
+        ]
     ke_dict = {
         "data": hail_ke_dataset,
         "units": "Jm-2s-1",